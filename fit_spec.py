@@ -20,6 +20,7 @@
 ## Updated:
 ##    26-APR-2023 -- v10, Initial creation
 ##    27-APR-2023 -- v11, Add some columns in the output file
+##    15-OCT-2026 -- v12, Fit the sources in parallel
 ##
 ## Todo: general functions for more flexibility
 ##       call parameters
@@ -27,14 +28,14 @@
 ##       put user parameters in an input file
 
 import os
-import importlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
-import lmfit
+import pandas as pd
 import astropy.units as u
 from specutils import Spectrum1D
 
 import mod_tools
-importlib.reload(mod_tools)
 
 
 # Input and output folders
@@ -92,7 +93,22 @@ wl_rest = c/f_rest.to(u.Hz)
 wl_rest = wl_rest.to(u.mm)
 
 
-for src in source_list:
+#---------------------------------------------------------------------------------------
+def fit_source(src,input,output,user_params):
+   """!
+   Fit the average spectrum of one source and save the Gaussian parameters
+
+   @param src: List : entry of the source list
+   @param input: String : folder containing the spectra
+   @param output: String : folder where the Gaussian parameters are saved
+   @param user_params: Dict : lim_gauss, lim_sigma, dvel, spec_reso and wl_rest
+   """
+   lim_gauss = user_params['lim_gauss']
+   lim_sigma = user_params['lim_sigma']
+   dvel      = user_params['dvel']
+   spec_reso = user_params['spec_reso']
+   wl_rest   = user_params['wl_rest']
+
    # Extract the relevant values from the Mini-Catalogue
    src_name = src[0]
    src_vel  = src[3]*u.km/u.s
@@ -103,62 +119,80 @@ for src in source_list:
 
    if not os.path.exists(infile):
       #print('There is no data for %s'%(src_name))
-      continue
-   if not os.path.exists(output): os.makedirs(output)
+      return
    print(src_name)
 
    # Read the spectrum and calculate the rms
-   nu,Tsource = np.loadtxt(infile,usecols=[0,1],delimiter=',',unpack=True)
-   samp = np.where(np.isfinite(Tsource))   # Remove NaN at the end of the spectrum
-   spec = Spectrum1D(spectral_axis=nu[samp]/1e6*u.MHz,flux=Tsource[samp]*u.K,
+   # pandas C parser, much faster than np.loadtxt on long spectra
+   nu,Tsource = pd.read_csv(infile,header=None,usecols=[0,1],comment='#').to_numpy(float).T
+   finite  = np.isfinite(Tsource)   # Remove NaN at the end of the spectrum
+   nu      = nu[finite]
+   Tsource = Tsource[finite]
+   spec = Spectrum1D(spectral_axis=nu/1e6*u.MHz,flux=Tsource*u.K,
                      rest_value=6668.5192*u.MHz,velocity_convention='optical')
 
-   rms  = mod_tools.compute_rms(spec,src_vel.value,dvel)
+   vel_arr  = spec.velocity.to(u.km/u.s).value
+   freq_arr = spec.spectral_axis.to(u.MHz).value
+   inband   = (vel_arr>=src_vel.value-dvel)&(vel_arr<=src_vel.value+dvel)
+   offband  = ~inband
+
+   rms  = mod_tools.compute_rms(Tsource,offband)
    print('rms=',rms)
 
-   # Initial guest for the first Gaussian
-   A     = np.nanmax(Tsource)
-   mu    = np.where(Tsource==A)[0][0]
+   # Initial guest for the first Gaussian, at the peak of the matched filter
+   mu    = int(np.argmax(mod_tools.matched_filter(Tsource,lim_sigma[0])))
+   A     = Tsource[mu]
    sigma = 10.
 
-   samp = np.where((spec.velocity>=src_vel-dvel*u.km/u.s)&
-                   (spec.velocity<=src_vel+dvel*u.km/u.s))
-   pars = lmfit.Parameters()
-   pars.add('g1_A',    value=A,    min=3*rms,     max=np.nanmax(Tsource)) 
-   pars.add('g1_mu',   value=mu,   min=samp[0][0],  max=samp[0][-1]) 
-   pars.add('g1_sigma',value=sigma,min=lim_sigma[0],max=lim_sigma[1])
+   samp  = np.flatnonzero(inband)
+   state = mod_tools.GaussState(A,mu,sigma,(3*rms,np.nanmax(Tsource)),
+                                (samp[0],samp[-1]),lim_sigma)
 
    # Fit of the average spectrum
-   guess = mod_tools.first_guest(pars,spec,src_vel.value,dvel,lim_sigma,lim_gauss,'leastsq')
+   guess = mod_tools.first_guest(state,spec,offband,lim_sigma,lim_gauss,'trf',rms=rms)
+   if guess is None:
+      print('The fit of %s failed.'%(src_name))
+      return
    print('The best fit (reduced chi2=%4.2f) predicts %i gaussians.'
-            %(guess.redchi,len(guess.params)/3))
+            %(guess.redchi,guess.state.n))
 
    # Save the Gaussian parameters
-   parvals = guess.params.valuesdict()
-   Ngauss  = int(len(parvals)/3)
+   best = guess.state
 
    out = open(outfile,'w')
    out.write('# Gaussian      A        mu         sig       nu0       FWHM       v0        FWHM\n')
    out.write('#              [K]                           [MHz]      [kHz]    [km/s]      [m/s]\n')
 
-   for k in np.arange(Ngauss)+1:
-       string  = '     %2i   '%(k)
-       string += '   %6.3f'   %(parvals['g%i_A'%(k)])
-       string += '   %9.4f'   %(parvals['g%i_mu'%(k)])
-       string += '   %6.3f'   %(parvals['g%i_sigma'%(k)])
+   for k in range(best.n):
+       string  = '     %2i   '%(k+1)
+       string += '   %6.3f'   %(best.A[k])
+       string += '   %9.4f'   %(best.mu[k])
+       string += '   %6.3f'   %(best.sigma[k])
 
-       nu0  = spec.spectral_axis[int(round(parvals['g%i_mu'%(k)]))]
-       FWHM = 2.354*parvals['g%i_sigma'%(k)]*spec_reso*1e3 # kHz
-       string += '   %9.4f'   %(nu0.value)
+       nu0  = freq_arr[int(round(best.mu[k]))]
+       FWHM = 2.354*best.sigma[k]*spec_reso*1e3 # kHz
+       string += '   %9.4f'   %(nu0)
        string += '   %6.3f'   %(FWHM.value)
 
-       v0   = spec.velocity[int(round(parvals['g%i_mu'%(k)]))]
-       FWHM = 2.354*parvals['g%i_sigma'%(k)]*spec_reso*wl_rest # km/s
+       v0   = vel_arr[int(round(best.mu[k]))]
+       FWHM = 2.354*best.sigma[k]*spec_reso*wl_rest # km/s
        FWHM = FWHM.to(u.m/u.s)
-       string += '   % 7.4f'  %(v0.value)
+       string += '   % 7.4f'  %(v0)
        string += '   %7.2f'   %(FWHM.value)
        out.write(string+'\n')
 
    out.close()
 
+#---------------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+   if output: os.makedirs(output,exist_ok=True)
+
+   user_params = {'lim_gauss':lim_gauss, 'lim_sigma':lim_sigma, 'dvel':dvel,
+                  'spec_reso':spec_reso, 'wl_rest':wl_rest}
 
+   # Each source is independent: fit them in parallel, one process per core
+   with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+      list(ex.map(partial(fit_source,input=input,output=output,user_params=user_params),
+                  source_list))
@@ -21,175 +21,345 @@
 ##    13-APR-2017 -- v10, Original version by Antoine Marchal
 ##    10-JUN-2022 -- v20, Adapted by Quentin Salomé
 ##    26-APR-2023 -- v21, Change the function compute_rms()
+##    15-OCT-2026 -- v22, Fit with scipy least_squares and an analytic Jacobian
 
+import math
+from dataclasses import dataclass
+from functools import lru_cache
 import numpy as np
 import lmfit
+from numba import njit
+from lmfit.minimizer import MinimizerResult
+from scipy.optimize import least_squares
+from scipy.signal import fftconvolve
 
 
-def compute_rms(spectrum,v0,dvel):
+@lru_cache(maxsize=None)
+def param_names(n):
     """!
-    Compute the standard deviation between v0-dvel and v0+dvel
+    Names of the lmfit parameters of n Gaussian, built once per n
     
-    @param spectrum: Spectrum1D : Spectrum to process
-    @param v0: float : Central velocity of the emission
-    @param dvel: float : Define the range of velocity containing the emission
+    @param n: Int : number of Gaussian
+    
+    @return tuple of (g%i_A, g%i_mu, g%i_sigma)
+    """
+    return tuple(('g%i_A'%(i),'g%i_mu'%(i),'g%i_sigma'%(i)) for i in range(1,n+1))
+
+
+@dataclass
+class GaussState:
+    """!
+    Set of Gaussian parameters stored as arrays, one entry per Gaussian
+    
+    @param A: 1D array : amplitudes
+    @param mu: 1D array : centers (in channel unit)
+    @param sigma: 1D array : dispersions (in channel unit)
+    @param A_bounds: 2D array : (min,max) of each amplitude
+    @param mu_bounds: 2D array : (min,max) of each center
+    @param sigma_bounds: 2D array : (min,max) of each dispersion
+    """
+    A: np.ndarray
+    mu: np.ndarray
+    sigma: np.ndarray
+    A_bounds: np.ndarray
+    mu_bounds: np.ndarray
+    sigma_bounds: np.ndarray
+
+    def __post_init__(self):
+        self.A     = np.atleast_1d(np.asarray(self.A,float))
+        self.mu    = np.atleast_1d(np.asarray(self.mu,float))
+        self.sigma = np.atleast_1d(np.asarray(self.sigma,float))
+        self.A_bounds     = np.atleast_2d(np.asarray(self.A_bounds,float))
+        self.mu_bounds    = np.atleast_2d(np.asarray(self.mu_bounds,float))
+        self.sigma_bounds = np.atleast_2d(np.asarray(self.sigma_bounds,float))
+
+    @property
+    def n(self):
+        return self.A.size
+
+    def append(self,A,mu,sigma,A_bounds,mu_bounds,sigma_bounds):
+        """!
+        Return a new set of parameters with one more Gaussian
+        """
+        return GaussState(np.append(self.A,A),np.append(self.mu,mu),
+                          np.append(self.sigma,sigma),
+                          np.vstack((self.A_bounds,A_bounds)),
+                          np.vstack((self.mu_bounds,mu_bounds)),
+                          np.vstack((self.sigma_bounds,sigma_bounds)))
+
+    def to_flat(self):
+        """!
+        @return 1D array : parameters (A1,mu1,sigma1,A2,mu2,sigma2,...)
+        """
+        return np.column_stack((self.A,self.mu,self.sigma)).ravel()
+
+    def from_flat(self,p):
+        """!
+        @return new set of parameters with the values of p and the same bounds
+        """
+        p = p.reshape(-1,3)
+        return GaussState(p[:,0],p[:,1],p[:,2],
+                          self.A_bounds,self.mu_bounds,self.sigma_bounds)
+
+    def flat_bounds(self):
+        """!
+        @return lower and upper bounds ordered as to_flat()
+        """
+        lb = np.column_stack((self.A_bounds[:,0],self.mu_bounds[:,0],self.sigma_bounds[:,0]))
+        ub = np.column_stack((self.A_bounds[:,1],self.mu_bounds[:,1],self.sigma_bounds[:,1]))
+        return lb.ravel(),ub.ravel()
+
+    def to_params(self):
+        """!
+        @return lmfit Parameters (g1_A, g1_mu, g1_sigma, g2_A, ...)
+        """
+        pars = lmfit.Parameters()
+        for i,(name_A,name_mu,name_sigma) in enumerate(param_names(self.n)):
+            pars.add(name_A,    value=self.A[i],
+                     min=self.A_bounds[i,0],    max=self.A_bounds[i,1])
+            pars.add(name_mu,   value=self.mu[i],
+                     min=self.mu_bounds[i,0],   max=self.mu_bounds[i,1])
+            pars.add(name_sigma,value=self.sigma[i],
+                     min=self.sigma_bounds[i,0],max=self.sigma_bounds[i,1])
+        return pars
+
+
+def compute_rms(flux,offband):
+    """!
+    Compute the standard deviation outside of the range containing the emission
+    
+    @param flux: 1D array : flux values of the spectrum
+    @param offband: 1D bool array : channels outside of v0-dvel and v0+dvel
     
     @return standard deviation
     """
-    if(np.nansum(spectrum.flux)==0): return float('nan')
+    if(np.nansum(flux)==0): return float('nan')
     else:
-        samp = np.where((spectrum.velocity.value<v0-dvel)|(spectrum.velocity.value>v0+dvel))
-        return np.nanstd(spectrum.flux[samp].value)
+        return np.nanstd(flux[offband])
 
 
-def gaussian(x,A,mu,sigma):
+def matched_filter(y,sigma):
     """!
-    Gaussian function
+    Convolve a spectrum with a Gaussian kernel (matched filter)
     
-    @param x: 1D array : velocity in channel unit  
-    @param A: Float : amplitude
-    @param mu: Float : center
-    @param sigma: Float : dispersion
+    @param y: 1D array : spectrum
+    @param sigma: Float : dispersion of the kernel in channel unit
 
-    @return gaussian(x)
+    @return smoothed spectrum
     """
-    return A*np.exp(-((x-mu)**2)/(2.*sigma**2))
+    half = int(np.ceil(5*sigma))
+    kern = np.exp(-0.5*(np.arange(-half,half+1)/sigma)**2)
+    return fftconvolve(np.nan_to_num(y),kern,mode='same')
 
 
-def first_guest(pars,spectrum,v0,dvel,lim_sigma,lim,method):
+@njit(fastmath=True,cache=True)
+def _sum_gauss(x,A,mu,sigma,out):
+    """!
+    Sum of Gaussian evaluated in a single compiled loop
+    
+    @param x: 1D array : velocity in channel unit
+    @param A: 1D array : amplitudes
+    @param mu: 1D array : centers
+    @param sigma: 1D array : dispersions
+    @param out: 1D array : buffer where the sum is written
+
+    @return out, sum of the gaussians at x
+    """
+    out[:] = 0.
+    for i in range(A.shape[0]):
+        s2 = 1.0/(2.*sigma[i]*sigma[i])
+        for j in range(x.shape[0]):
+            d = x[j]-mu[i]
+            out[j] += A[i]*math.exp(-d*d*s2)
+    return out
+
+
+def first_guest(state,spectrum,offband,lim_sigma,lim,method,rms=None):
     """!
     Fit the initial specturm to pass it to the hierarchical descent
     
-    @param pars: lmfit method : 1 set of gaussian parameters
+    @param state: GaussState : 1 set of gaussian parameters
     @param spectrum: 1D array : spectrum / brightness Temperature
-    @param v0: float : Central velocity of the emission
-    @param dvel: float : Define the range of velocity containing the emission
+    @param offband: 1D bool array : channels outside of the emission, used for the rms
     @param lim_sigma: List : limits of the range where sigma is fitted
     @param lim: Int : max number of Gaussian fitted
     @param method: String : minimization method
+    @param rms: float : rms of the spectrum, computed if not given
 
-    @return lmfit obj
+    @return lmfit obj with the best fit in params and state, None if the fit failed
     """
     y = spectrum.flux.value
-    rms = compute_rms(spectrum,v0,dvel)
+    if rms is None: rms = compute_rms(y,offband)
     x = np.arange(len(y))
-    err = np.ones(len(y))*rms
+    inv_err = np.full_like(y,1./rms)
+    buf = np.empty_like(y)   # work buffer for the residual in add_gaussian
 
-    n_gauss = len(pars)/3
-
-    global_fit = minimize(y,pars,rms,method)
+    global_fit = minimize(y,x,inv_err,state,method)
+    if global_fit is None: return None
 
     if global_fit.redchi > 1.:
         redchi2 = 99.
         saveredchi2 = global_fit.redchi
-        while ((redchi2>0.90) & (len(pars)/3<lim)):
-            new_params = add_gaussian(y,pars,lim_sigma,rms)
-            fit = minimize(y,new_params,rms,method)
+        prevredchi2 = global_fit.redchi
+        while ((redchi2>0.90) & (state.n<lim)):
+            # Warm start: the previous Gaussians start from their fitted values
+            new_state = add_gaussian(y,x,state,lim_sigma,rms,buf=buf)
+            fit = minimize(y,x,inv_err,new_state,method)
+            if fit is None: break
             redchi2 = fit.redchi
             if ((redchi2<saveredchi2)&(redchi2>0.98)):
                 saveredchi2 = redchi2
                 save = fit
-            pars = fit.params
+            state = fit.state
+            # Stop when the new Gaussian does not change the fit anymore
+            if abs(prevredchi2-redchi2)<1e-3: break
+            prevredchi2 = redchi2
 
     try:
-        return save
+        best = save
     except:
-        return global_fit
+        best = global_fit
+
+    # lmfit Parameters are only built for the retained fit
+    best.params = best.state.to_params()
+    return best
 
 
-def add_gaussian(y,params,lim_sigma,rms):
+def add_gaussian(y,x,state,lim_sigma,rms,buf=None):
     """!
     Add a new gaussian
     
     @param y: 1D array : spectrum
-    @param params: lmfit method : set of previous parameters
+    @param x: 1D array : velocity in channel unit
+    @param state: GaussState : set of previous parameters
     @param lim_sigma: List : limits of the range where sigma is fitted
+    @param buf: 1D array : optional buffer where the residual is written
     
-    @return list of params with a new gaussian
+    @return GaussState with a new gaussian
     """
-    n = int(len(params)/3)
-    
-    residu = residual(params,np.arange(len(y)),y)
-    pars = lmfit.Parameters()
-    for i in np.arange(n)+1:
-        new_gauss = lmfit.Model(gaussian,prefix='g%i_'%(i))
-    
-        pars.update(new_gauss.make_params())
-        
-        A = params['g%i_A'%(i)].value
-        mu = params['g%i_mu'%(i)].value
-        sigma = params['g%i_sigma'%(i)].value
-        
-        pars.add('g%i_A'%(i),    value=A,    min=3*rms,            max=np.max(y))
-        pars.add('g%i_mu'%(i),   value=mu,   min=params['g1_mu'].min,max=params['g1_mu'].max)
-        pars.add('g%i_sigma'%(i),value=sigma,min=lim_sigma[0],       max=lim_sigma[1])
-                        
-    new_gauss = lmfit.Model(gaussian, prefix='g%i_'%(n+1))
-    pars.update(new_gauss.make_params())
-
-    p = np.argsort(np.random.randn(n))[0]+1
-
-    loc = np.where(residu == np.min(residu))[0][0]
+    n = state.n
+    ymax = float(np.max(y))
+    mu_min,mu_max = state.mu_bounds[0]
+    
+    residu = residual(state,x,y,out=buf)
+
+    # Reset the bounds of the previous Gaussians
+    state = GaussState(state.A,state.mu,state.sigma,
+                       np.tile((3*rms,ymax),(n,1)),
+                       np.tile((mu_min,mu_max),(n,1)),
+                       np.tile(lim_sigma,(n,1)))
+
+    p = np.random.randint(n)
+
+    # Place the new Gaussian where the smoothed residual is the most negative
+    loc = int(np.argmin(matched_filter(residu,lim_sigma[0])))
     A = y[loc]
     mu = loc
-    sigma = params['g%i_sigma'%(p)].value
+    sigma = state.sigma[p]
 
-    pars['g%i_A'%(n+1)].set(A,        min=0.,max=np.max(y))
-    pars['g%i_mu'%(n+1)].set(mu,      min=0.,max=len(y))
-    pars['g%i_sigma'%(n+1)].set(sigma,min=lim_sigma[0],max=lim_sigma[1])
-    return pars
+    return state.append(A,mu,sigma,(0.,ymax),(0.,len(y)),lim_sigma)
 
 
-def residual(pars,x,data=None,eps=None):
+def residual(state,x,data=None,inv_eps=None,out=None):
     """!
     Compute model, residual with and without errors
     
-    @param pars: lmfit method : list of Gaussian
+    @param state: GaussState : list of Gaussian
     @param x: 1D array : velocity in channel unit
     @param data: 1D array : spectrum / Brightness Temperature
-    @param eps: 1D array : errors
+    @param inv_eps: 1D array : inverse of the errors
+    @param out: 1D array : optional buffer where the result is written
     
     @return model if data is None \n
-    model - data if eps is None \n
+    model - data if inv_eps is None \n
     (model - data) / eps else
     """
-    parvals = pars.valuesdict()
-
-    model = 0
-
-    n = len(parvals) / 3
+    if out is None: out = np.empty(len(x))
+    model = _sum_gauss(x,state.A,state.mu,state.sigma,out)
 
-    for i in np.arange(n) + 1:
-        model += gaussian(x,parvals['g%i_A'%(i)],parvals['g%i_mu'%(i)],parvals['g%i_sigma'%(i)])
-        
     if data is None:
         return model
-    if eps is None:
-        return (model-data)
-    return (model-data)/eps
+    np.subtract(model,data,out=out)
+    if inv_eps is None:
+        return out
+    return np.multiply(out,inv_eps,out=out)
 
 
-def minimize(y,params,rms,method):
+def resid(p,x,y,inv_eps):
     """!
-    Minimize the spectrum with a list of Gaussian
+    Residual of the sum of Gaussian on flat parameters (for least_squares)
     
+    @param p: 1D array : parameters (A1,mu1,sigma1,A2,mu2,sigma2,...)
+    @param x: 1D array : velocity in channel unit
     @param y: 1D array : spectrum / Brightness Temperature
-    @param params: lmfit method : list of Gaussian
-    @param rms: Float : rms of spectrum to fit
-    @param method: String : minimization method
+    @param inv_eps: 1D array : inverse of the errors
     
-    @return lmfit obj
+    @return (model - data) / eps
     """
-    x = np.arange(len(y))
-    err = np.ones(len(y))*rms
-    n = len(params)/3
+    p = p.reshape(-1,3)
+    model = _sum_gauss(x,p[:,0],p[:,1],p[:,2],np.empty(len(x)))
+    return (model-y)*inv_eps
+
+
+def jac(p,x,y,inv_eps):
+    """!
+    Analytic Jacobian of resid()
+    
+    @param p: 1D array : parameters (A1,mu1,sigma1,A2,mu2,sigma2,...)
+    @param x: 1D array : velocity in channel unit
+    @param y: 1D array : spectrum / Brightness Temperature
+    @param inv_eps: 1D array : inverse of the errors
+    
+    @return 2D array of shape (len(x),len(p))
+    """
+    p = p.reshape(-1,3)
+    sigma = p[:,2]
+    diff = x[:,None]-p[:,1]
+    e = np.exp(-0.5*(diff/sigma)**2)
+    g = p[:,0]*e
+
+    J = np.empty((len(x),len(p),3))
+    J[:,:,0] = e
+    J[:,:,1] = g*diff/sigma**2
+    J[:,:,2] = g*diff**2/sigma**3
+    return J.reshape(len(x),-1)*inv_eps[:,None]
+
+
+def minimize(y,x,inv_err,state,method):
+    """!
+    Minimize the spectrum with a list of Gaussian
     
-    fitter = lmfit.Minimizer(residual,params,fcn_args=(x,y,err))
+    @param y: 1D array : spectrum / Brightness Temperature
+    @param x: 1D array : velocity in channel unit
+    @param inv_err: 1D array : inverse of the errors (1/rms)
+    @param state: GaussState : list of Gaussian
+    @param method: String : least_squares method supporting bounds ('trf' or 'dogbox')
+    
+    @return lmfit obj, with the fitted GaussState in its attribute state \n
+    None if the fit failed
+    """
+    lb,ub = state.flat_bounds()
+    # As lmfit, accept inverted bounds (e.g. 3*rms above the peak of a weak
+    # source); least_squares also needs lb strictly below ub
+    lb,ub = np.minimum(lb,ub),np.maximum(lb,ub)
+    ub = np.where(lb<ub,ub,np.nextafter(lb,np.inf))
+    p0 = np.clip(state.to_flat(),lb,ub)
+
+    fit = None
+
     try:
-        fit = fitter.minimize(method=method)
+        sol = least_squares(resid,p0,jac=jac,bounds=(lb,ub),method=method,
+                            x_scale='jac',xtol=1e-6,ftol=1e-6,gtol=1e-6,
+                            args=(x,y,inv_err))
+
+        new_state = state.from_flat(sol.x)
+        chisqr = np.sum(sol.fun**2)
+        nfree  = len(y)-len(p0)
+        fit = MinimizerResult(state=new_state,
+                              chisqr=chisqr,redchi=chisqr/nfree,
+                              ndata=len(y),nvarys=len(p0),nfree=nfree,
+                              nfev=sol.nfev,success=sol.success,message=sol.message)
     except Exception as mes: 
         print("Something wrong with fit: ", mes)
         pass
     return fit
-
-
@@ -28,16 +28,13 @@
 import os
 import importlib
 import numpy as np
+import pandas as pd
 import astropy.units as u
 from specutils import Spectrum1D
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
 
-#---------------------------------------------------------------------------------------
-def gaussian(x,A,mu,sigma):
-    return A*np.exp(-((x-mu)**2)/(2.*sigma**2))
-
 #---------------------------------------------------------------------------------------
 def freq2vel(nu,frest):
    nu  = np.array(nu, float)
@@ -97,7 +94,9 @@ source_list=[
 ]
 
 
+if output: os.makedirs(output,exist_ok=True)
 pdf2 = PdfPages(output+'Average_spectra.pdf')
+fig,ax1 = plt.subplots()   # the same figure is cleared and reused for every source
 
 
 for src in source_list:
@@ -115,22 +114,25 @@ for src in source_list:
 
 
    # Read the spectrum
-   nu,Tsource = np.loadtxt(specfile,usecols=[0,1],delimiter=',',unpack=True)
-   samp = np.where(np.isfinite(Tsource))   # Remove NaN at the end of the spectrum
-   spec = Spectrum1D(spectral_axis=nu[samp]/1e6*u.MHz,flux=Tsource[samp]*u.K,
+   # pandas C parser, much faster than np.loadtxt on long spectra
+   nu,Tsource = pd.read_csv(specfile,header=None,usecols=[0,1],comment='#').to_numpy(float).T
+   finite  = np.isfinite(Tsource)   # Remove NaN at the end of the spectrum
+   nu      = nu[finite]
+   Tsource = Tsource[finite]
+   spec = Spectrum1D(spectral_axis=nu/1e6*u.MHz,flux=Tsource*u.K,
                      rest_value=6668.5192*u.MHz,velocity_convention='optical')
+   vel_arr = spec.velocity.to(u.km/u.s).value
 
 
    # Read the Gaussian parameters
    A,mu,sigma = np.loadtxt(gaussfile,usecols=[1,2,3],ndmin=2,unpack=True)
 
    # Plot
-   pdf = PdfPages(output+'%s_mean_spectrum.pdf'%(src_name))
-   fig,ax1 = plt.subplots()
+   ax1.cla()
 #   ax2 = ax1.twiny()
 
    # automatically update ylim of ax2 when ylim of ax1 changes.
-   ax1.step(spec.velocity,spec.flux,where='mid',color='r',linewidth=1.,label='Mean spectrum')
+   ax1.step(vel_arr,spec.flux.value,where='mid',color='r',linewidth=1.,label='Mean spectrum')
    x1,x2 = ax1.get_xlim()
 #   ax2.set_xlim(vel2freq(x1,6668.5192),vel2freq(x2,6668.5192))
 #   ax2.figure.canvas.draw()
@@ -141,30 +143,28 @@ for src in source_list:
    ax1.set_ylabel('T [ K ]')
 #   ax2.set_ylabel('$\\nu$ [ MHz ]')
 
-   chan = np.arange(len(spec.flux))
-   sum  = np.zeros(len(spec.flux))
+   chan  = np.arange(len(vel_arr))
+   comps = A[:,None]*np.exp(-0.5*((chan[None,:]-mu[:,None])/sigma[:,None])**2)
+   sum   = comps.sum(axis=0)
 
-   for k in np.arange(len(A)):
-       sum += gaussian(chan,A[k],mu[k],sigma[k])
+   for k,row in enumerate(comps):
        if k == 1:
-           ax1.plot(spec.velocity,gaussian(chan,A[k],mu[k],sigma[k]),
-                  'b--',linewidth=1.,label='Gaussian')
+           ax1.plot(vel_arr,row,'b--',linewidth=1.,label='Gaussian')
        else:
-           ax1.plot(spec.velocity,gaussian(chan,A[k],mu[k],sigma[k]),
-                  'b--',linewidth=1.)
+           ax1.plot(vel_arr,row,'b--',linewidth=1.)
 
-   ax1.plot(spec.velocity,sum,'k--',linewidth=1.,label='Model')
+   ax1.plot(vel_arr,sum,'k--',linewidth=1.,label='Model')
    ax1.legend(loc = 1, numpoints = 1)
    leg = ax1.get_legend()
    ltext  = leg.get_texts()
    plt.setp(ltext, fontsize = 'small')
 
    # Save mean spectrum
-   plt.savefig(pdf, format='pdf')
-   plt.savefig(pdf2, format='pdf')
-   plt.close()
-   pdf.close()
+   with PdfPages(output+'%s_mean_spectrum.pdf'%(src_name)) as pdf:
+      fig.savefig(pdf, format='pdf')
+   fig.savefig(pdf2, format='pdf')
 
+plt.close(fig)
 pdf2.close()
 
 